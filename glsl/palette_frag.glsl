@@ -4,11 +4,12 @@ precision lowp float;
 
 layout (binding = 0) uniform usampler2DArray image;
 layout (binding = 1) uniform usampler2D overlay;
+layout (binding = 2) uniform sampler1D palette;
 
 layout (location = 2) uniform float global_alpha = 1;
 layout (location = 3) uniform ivec2 slice;
 layout (location = 4) uniform uint transparent_color = 0;
-layout (location = 5) uniform vec4[256] palette;
+layout (location = 6) uniform int cursor = 0;
 
 in VS_OUT {
   vec4 texcoord;
@@ -22,36 +23,44 @@ layout (location=0) out vec4 color;
 void main(void) {
   ivec3 size = textureSize(image, 0);
   uvec4 over_pixel = texture(overlay, fs_in.overlay_coord);
-  vec3 direction = clamp(fs_in.look_dir.xyz, -1, 0);
-  //vec3 limits = size + direction;  
-  // ivec3 offset = -direction * int(round(fs_in.look_dir.xyz)) * size;
-  uint index;
-  if (over_pixel.a > 0) {
-    index = over_pixel.r;
-    vec4 color_ = palette[index];
-    if (color_.a == 0) {
-      discard;
-    }
-    color = vec4(color_.rgb, global_alpha);
-  } else {
-    uvec4 pixel;
-    vec3 base_coord = size * fs_in.texcoord.xyz;
-    for (int i = slice[0]; i < slice[1]; i++) {
+  vec3 base_coord = size * fs_in.texcoord.xyz;
+
+  // Composite all the layers front-to-back in a single pass. The current
+  // layer (including the overlay) is drawn opaque, the others with
+  // global_alpha. "result" is premultiplied while accumulating.
+  vec4 result = vec4(0);
+  for (int i = slice[0]; i < slice[1]; i++) {
+    vec4 layer_color;
+    if (i == cursor && over_pixel.a > 0) {
+      layer_color = texelFetch(palette, int(over_pixel.r), 0);
+      if (layer_color.a == 0) {
+        continue;
+      }
+    } else {
       // TODO The coordinate formula is complicated by the fact that the array index
       // must be [0, z) (where z is the current depth direction). Therefore just
       // multiplying by the size does not work correctly when counting down.
       // Try to figure out a better way.
       vec3 tex_coord = vec3(base_coord + (i + 0.5) * fs_in.look_dir.xyz);
-      pixel = texelFetch(image, ivec3(floor(tex_coord)), 0);
-      if (pixel.r != transparent_color) {
-        // Take the topmost non transparent pixel.
-        break;
+      uvec4 pixel = texelFetch(image, ivec3(floor(tex_coord)), 0);
+      if (pixel.r == transparent_color || pixel.a == 0) {
+        continue;
+      }
+      layer_color = texelFetch(palette, int(pixel.r), 0);
+      if (layer_color.a == 0) {
+        continue;
       }
-    } 
-    index = pixel.r;
-    vec4 color_ = palette[index];
-    if (pixel.a == 0 || color_.a == 0)
-      discard;
-    color = vec4(color_.rgb, global_alpha);
+    }
+    float alpha = (i == cursor) ? 1 : global_alpha;
+    result.rgb += (1 - result.a) * alpha * layer_color.rgb;
+    result.a += (1 - result.a) * alpha;
+    if (result.a >= 0.999) {
+      // Effectively opaque already; the rest of the layers can't show through.
+      break;
+    }
+  }
+  if (result.a == 0) {
+    discard;
   }
+  color = vec4(result.rgb / result.a, result.a);
 }
@@ -1,282 +1,258 @@
-from ctypes import c_ubyte
-from itertools import chain, product
-from functools import lru_cache
-from concurrent.futures import ThreadPoolExecutor
+import ctypes
+from ctypes import byref
 import math
 from time import time
 
 from euclid3 import Matrix4
-import numpy as np
 from pyglet import gl
 
-from fogl.framebuffer import FrameBuffer
 from fogl.glutil import gl_matrix
-from fogl.mesh import Mesh
-from fogl.shader import Program, VertexShader, FragmentShader
-from fogl.texture import Texture, NormalTexture
-from fogl.vertex import Vertices
-from fogl.vao import VertexArrayObject
-from fogl.util import enabled, disabled
+from fogl.texture import Texture
 
-
-VERTEX_SHADER = b"""
-#version 450 core
-precision highp float;
-
-layout (location = 0) in ivec4 position;
-layout (location = 1) in uint color_index;
-layout (location = 2) in ivec4 normal;
-
-layout (location = 0) uniform mat4 proj_matrix;
-layout (location = 3) uniform vec4[256] palette;
-
-out VS_OUT {
-  vec4 color;
-  vec4 normal;
-} vs_out;
+from voxpaint.render import _get_3d_texture, _update_palette
+from voxpaint.util import instance_lru_cache
 
 
-void main() {
-  gl_Position = proj_matrix * position;
-  vs_out.color = palette[color_index];
-  vs_out.normal = normal;
-}
-"""
-
-FRAGMENT_SHADER = b"""
+COMPUTE_SHADER = b"""
 #version 450 core
 
-layout (location = 1) uniform vec4 color = vec4(1, 1, 1, 1);
+layout (local_size_x = 8, local_size_y = 8) in;
 
-in VS_OUT {
-  vec4 color;
-  vec4 normal;
-} fs_in;
+layout (binding = 0) uniform usampler2DArray voxels;
+layout (binding = 2) uniform sampler1D palette;
 
+layout (location = 0) uniform mat4 inv_proj_matrix;
 
-layout (location = 0) out vec4 color_out;
-layout (location = 1) out vec4 normal_out;
-layout (location = 2) out vec4 position_out;
+layout (rgba8, binding = 0) writeonly uniform image2D color_out;
 
 
 void main(void) {
-  float z = gl_FragCoord.z;
-  float light = 1 - 0.5 * z;
-  color_out = fs_in.color * vec4(light, light, light, 1);
-  //color_out = palette[fs_in.color];
-  normal_out = fs_in.normal;
-  position_out = gl_FragCoord;
+  ivec2 pixel = ivec2(gl_GlobalInvocationID.xy);
+  ivec2 screen_size = imageSize(color_out);
+  if (pixel.x >= screen_size.x || pixel.y >= screen_size.y)
+    return;
+
+  ivec3 size = textureSize(voxels, 0);
+
+  // Unproject the near and far ends of the ray through this pixel. The
+  // projection is orthographic, so w stays 1 and the t parameter below runs
+  // linearly from the near plane (t=0) to the far plane (t=1).
+  vec2 ndc = (2 * (vec2(pixel) + 0.5)) / vec2(screen_size) - 1;
+  vec3 start = (inv_proj_matrix * vec4(ndc, -1, 1)).xyz;
+  vec3 end = (inv_proj_matrix * vec4(ndc, 1, 1)).xyz;
+
+  // Layer z occupies [-z, 1-z] along the model space z axis; substituting
+  // u = 1 - z makes cell (x, y, z) of the grid correspond directly to
+  // layer z of the texture.
+  start.z = 1 - start.z;
+  end.z = 1 - end.z;
+  vec3 dir = end - start;
+
+  // Clip the ray against the bounds of the volume.
+  vec3 lo = (vec3(0) - start) / dir;
+  vec3 hi = (vec3(size) - start) / dir;
+  vec3 tmin3 = min(lo, hi);
+  vec3 tmax3 = max(lo, hi);
+  float tmin = max(max(tmin3.x, tmin3.y), max(tmin3.z, 0));
+  float tmax = min(min(tmax3.x, tmax3.y), min(tmax3.z, 1));
+  if (tmax <= tmin) {
+    imageStore(color_out, pixel, vec4(0));
+    return;
+  }
+
+  // Step cell by cell through the volume (3D DDA) until we hit a voxel.
+  vec3 p = start + tmin * dir;
+  ivec3 cell = clamp(ivec3(floor(p)), ivec3(0), size - 1);
+  ivec3 istep = ivec3(sign(dir));
+  vec3 t_delta = abs(1 / dir);
+  vec3 next = (vec3(cell) + max(vec3(istep), 0) - start) / dir;
+  float t = tmin;
+  while (t < tmax) {
+    uint index = texelFetch(voxels, cell, 0).r;
+    if (index > 0) {
+      vec4 color = texelFetch(palette, int(index), 0);
+      if (color.a > 0) {
+        // t equals the depth buffer value the old mesh renderer shaded with.
+        float light = 1 - 0.5 * t;
+        imageStore(color_out, pixel, color * vec4(light, light, light, 1));
+        return;
+      }
+    }
+    if (next.x < next.y && next.x < next.z) {
+      t = next.x;
+      next.x += t_delta.x;
+      cell.x += istep.x;
+    } else if (next.y < next.z) {
+      t = next.y;
+      next.y += t_delta.y;
+      cell.y += istep.y;
+    } else {
+      t = next.z;
+      next.z += t_delta.z;
+      cell.z += istep.z;
+    }
+    if (any(lessThan(cell, ivec3(0))) || any(greaterThanEqual(cell, size)))
+      break;
+  }
+  imageStore(color_out, pixel, vec4(0));
 }
 """
 
 
-COPY_VERTEX_SHADER = b"""
-#version 450 core
-
-out VS_OUT {
-  vec2 texcoord;
-} vs_out;
-
-void main(void) {
-  const vec4 vertices[6] = vec4[6](vec4(-1, -1, 0, 1),
-                                   vec4(1, 1, 0, 1),
-                                   vec4(1, -1, 0, 1),
-
-                                   vec4(1, 1, 0, 1),
-                                   vec4(-1, -1, 0, 1),
-                                   vec4(-1, 1, 0, 1));
-
-  const vec2 texcoords[6] = vec2[6](vec2(0, 1),
-                                    vec2(1, 0),
-                                    vec2(1, 1),
-
-                                    vec2(1, 0),
-                                    vec2(0, 1),
-                                    vec2(0, 0));
-
-  gl_Position = vertices[gl_VertexID];
-  vs_out.texcoord = texcoords[gl_VertexID];
-}
-"""
-
-COPY_FRAGMENT_SHADER = b"""
-#version 450 core
-
-layout (binding=0) uniform sampler2D color;
-layout (binding=1) uniform sampler2D normal;
-layout (binding=2) uniform sampler2D position;
-
-in VS_OUT {
-  vec2 texcoord;
-} fs_in;
-
-layout (location = 0) out vec4 color_out;
-
-void main(void) {
-    color_out = texture(color, fs_in.texcoord);
-}
-"""
-
-
-class VoxelVertices(Vertices):
-    _fields = [
-        ('position', gl.GL_INT, 4),
-        ('color', gl.GL_UNSIGNED_INT, 1),
-        ('normal', gl.GL_INT, 4),
-    ]
-
-
-vertex_dtype = np.dtype([('position', gl.GLint * 4),
-                         ('index', gl.GLuint * 1),
-                         ('normal', gl.GLint * 4)])
+def _make_compute_program(source):
+    "Compile and link a compute shader. fogl has no wrapper for those (yet)."
+    shader = gl.glCreateShader(gl.GL_COMPUTE_SHADER)
+    src = ctypes.c_char_p(source)
+    length = gl.GLint(len(source))
+    gl.glShaderSource(shader, 1,
+                      ctypes.cast(byref(src), ctypes.POINTER(ctypes.POINTER(gl.GLchar))),
+                      byref(length))
+    gl.glCompileShader(shader)
+    status = gl.GLint()
+    gl.glGetShaderiv(shader, gl.GL_COMPILE_STATUS, byref(status))
+    if not status.value:
+        size = gl.GLint()
+        gl.glGetShaderiv(shader, gl.GL_INFO_LOG_LENGTH, byref(size))
+        log = ctypes.create_string_buffer(size.value)
+        gl.glGetShaderInfoLog(shader, size, None, log)
+        raise RuntimeError(log.value.decode())
+    program = gl.glCreateProgram()
+    gl.glAttachShader(program, shader)
+    gl.glLinkProgram(program)
+    gl.glGetProgramiv(program, gl.GL_LINK_STATUS, byref(status))
+    if not status.value:
+        size = gl.GLint()
+        gl.glGetProgramiv(program, gl.GL_INFO_LOG_LENGTH, byref(size))
+        log = ctypes.create_string_buffer(size.value)
+        gl.glGetProgramInfoLog(program, size, None, log)
+        raise RuntimeError(log.value.decode())
+    gl.glDeleteShader(shader)
+    return program
+
+
+SPIN_HZ = 60
 
 
 class Plugin:
 
     """
-    Show the current selection of the drawing as a three dimensional object.
+    Show the current drawing as a three dimensional object.
+
+    The voxels are raycast in a compute shader, straight out of the 3D
+    texture that render_view keeps up to date. That means there is no mesh
+    to rebuild and nothing to upload when the drawing changes; the data is
+    already on the GPU.
     """
 
     # TODO: Better shading, lighting
-    # TODO: Alternative rendering method, e.g. blocks
     # TODO: Highlight current layer somehow
-    
+
     period = 0.1
     last_run = 0
 
     def __init__(self):
-        self.program = Program(
-            VertexShader(source=VERTEX_SHADER),
-            FragmentShader(source=FRAGMENT_SHADER)
-        )
-        self._copy_program = Program(
-            VertexShader(source=COPY_VERTEX_SHADER),
-            FragmentShader(source=COPY_FRAGMENT_SHADER)
-        )
-        self._vao = VertexArrayObject()
+        self._program = _make_compute_program(COMPUTE_SHADER)
         self.texture = None
-
-    @lru_cache(1)
-    def _get_buffer(self, size):
-        render_textures = dict(
-            color=Texture(size, unit=0, params={gl.GL_TEXTURE_MIN_FILTER: gl.GL_LINEAR}),
-            normal=Texture(size, unit=1, params={gl.GL_TEXTURE_MIN_FILTER: gl.GL_LINEAR}),
-            position=Texture(size, unit=2, params={gl.GL_TEXTURE_MIN_FILTER: gl.GL_LINEAR}),
-        )
-        return FrameBuffer(size, render_textures, autoclear=True)
-
-    @lru_cache(1)
-    def _get_shadow_buffer(self, size):
-        render_textures = dict(
-            # color=Texture(size, unit=0, params={gl.GL_TEXTURE_MIN_FILTER: gl.GL_LINEAR}),
-            # normal=NormalTexture(size, unit=1, params={gl.GL_TEXTURE_MIN_FILTER: gl.GL_LINEAR}),
-            # position=NormalTexture(size, unit=2, params={gl.GL_TEXTURE_MIN_FILTER: gl.GL_LINEAR}),            
-        )
-        return FrameBuffer(size, render_textures, autoclear=True, depth_unit=4)
-
-    @lru_cache(1)
-    def _get_final_buffer(self, size):
-        render_textures = dict(
-            color=Texture(size, unit=0, params={gl.GL_TEXTURE_MIN_FILTER: gl.GL_LINEAR}),
-            normal=Texture(size, unit=1, params={gl.GL_TEXTURE_MIN_FILTER: gl.GL_LINEAR}),
-            position=Texture(size, unit=2, params={gl.GL_TEXTURE_MIN_FILTER: gl.GL_LINEAR}),            
+        # Which of the two render targets to draw into next; see __call__.
+        self._frame = 0
+        self._last_state = None
+
+    @instance_lru_cache(2)
+    def _get_texture(self, size, index):
+        return Texture(size, unit=0, params={gl.GL_TEXTURE_MIN_FILTER: gl.GL_LINEAR})
+
+    @instance_lru_cache(1)
+    def _get_inv_mvp_matrix(self, size, depth, view_size, altitude, azimuth):
+        """
+        Compose the inverse of the complete model/view/projection matrix,
+        which the shader uses to turn screen pixels back into rays through
+        the volume. The inputs only change when the user interacts, so this
+        saves redoing the euclid3 matrix math (pure Python) on every frame.
+        """
+        w, h = size
+        vw, vh = view_size
+        x = math.sin(math.pi/3)
+        model_matrix = (Matrix4
+                        .new_scale(1, 1, 1/x)
+                        .translate(-w//2, -h//2, depth//2 - 1/2))
+        far = w*2
+        near = -w*2
+        frust = Matrix4()
+        frust[:] = (2/vw, 0, 0, 0,
+                    0, 2/vh, 0, 0,
+                    0, 0, -2/(far-near), 0,
+                    0, 0, -(far+near)/(far-near), 1)
+        view_matrix = (
+            Matrix4
+            .new_translate(0, 0, -1)
+            .rotatex(altitude)
+            .rotatez(azimuth)
         )
-        return FrameBuffer(size, render_textures, autoclear=True)
-    
-    @lru_cache(1)
-    def _get_texture(self, size):
-        return Texture(size)
-    
-    @lru_cache(256)
-    def _get_float_color(self, r, g, b, a):
-        return r/255, g/255, b/255, a/255
-
-    @lru_cache(1)
-    def _get_mesh(self, drawing, version, hidden_layers):
-        nz = drawing.data.nonzero()
-        pixels = np.transpose(nz)
-        values = drawing.data[nz]
-        # TODO get rid of that "-z"?
-        # TODO This comprehension should be replaced with pure numpy operations
-        vertices = np.array([((x, y, -z, 1), (v, ), (0, 0, 1, 0))
-                             for (x, y, z), v in zip(pixels, values)],
-                            dtype=vertex_dtype)
-        if len(vertices):
-            # TODO probably would be better to not allocate new memory every time
-            # but then we have to somehow handle that the size can vary.
-            return Mesh(data=vertices, vertices_class=VoxelVertices)
-
-    @lru_cache(1)
-    def _get_colors(self, colors):
-        float_colors = chain.from_iterable((r / 255, g / 255, b / 255, a / 255)
-                                           for r, g, b, a in colors)
-        return (gl.GLfloat*(4*256))(*float_colors)
-        
-    def __call__(self, voxpaint, drawing, 
+        return gl_matrix((frust * view_matrix * model_matrix).inverse())
+
+    def __call__(self, voxpaint, drawing,
                  altitude: float=120, azimuth: float=45, spin: bool=False):
 
         size = drawing.size
         depth = drawing.shape[2]
-        colors = drawing.palette.colors
 
-        x = math.sin(math.pi/3)
-        
         altitude = math.radians(altitude)
         azimuth = math.radians(azimuth)
-        
-        mesh = self._get_mesh(drawing, drawing.version, drawing.hidden_layers_by_axis)
-        if not mesh:
-            # TODO hacky
-            self.texture and self.texture[0].clear()
-            return
+        if spin:
+            # Rotate over time. Quantized to whole ticks so that the angle is
+            # stable between consecutive frames of the same tick, keeping the
+            # matrix cache and the redraw check below usable while spinning.
+            azimuth = int(time() * SPIN_HZ) / SPIN_HZ
 
         w, h = size
         vw = int(w * math.sqrt(2))
         vh = int(h + math.sqrt(2) * h // 2)
         view_size = (vw, vh)
-        model_matrix = (Matrix4
-                        .new_scale(1, 1, 1/x)
-                        .translate(-w//2, -h//2, depth//2 - 1/2))
-
-        far = w*2
-        near = -w*2
-        frust = Matrix4()
-        frust[:] = (2/vw, 0, 0, 0,
-                    0, 2/vh, 0, 0,
-                    0, 0, -2/(far-near), 0,
-                    0, 0, -(far+near)/(far-near), 1)
 
-        offscreen_buffer = self._get_buffer(view_size)
-        with offscreen_buffer, self.program, \
-                enabled(gl.GL_DEPTH_TEST), disabled(gl.GL_CULL_FACE):
-
-            azimuth = time() if spin else azimuth
-            view_matrix = (
-                Matrix4
-                .new_translate(0, 0, -1)
-                .rotatex(altitude)
-                .rotatez(azimuth)  # Rotate over time
-            )
-            colors = self._get_colors(colors)
-            gl.glUniform4fv(3, 256, colors)
-
-            gl.glUniformMatrix4fv(0, 1, gl.GL_FALSE,
-                                  gl_matrix(frust * view_matrix * model_matrix))
-            gl.glViewport(0, 0, vw, vh)
-            gl.glPointSize(1)
-
-            mesh.draw(mode=gl.GL_POINTS)
-
-        final_buffer = self._get_final_buffer(view_size)
-
-        with self._vao, final_buffer, self._copy_program, disabled(gl.GL_CULL_FACE, gl.GL_DEPTH_TEST):
-            with offscreen_buffer["color"], offscreen_buffer["normal"], offscreen_buffer["position"]:
-                gl.glDrawArrays(gl.GL_TRIANGLES, 0, 6)
-
-        # TODO must be careful here so that the texture is always valid
-        # (since imgui may read it at any time) Find a way to ensure this.
-        texture = self._get_texture(view_size)
-        gl.glCopyImageSubData(final_buffer["color"].name, gl.GL_TEXTURE_2D, 0, 0, 0, 0,
-                              texture.name, gl.GL_TEXTURE_2D, 0, 0, 0, 0,
-                              vw, vh, 1)
+        # Consume the drawing's plugin dirty flag: it marks any data change,
+        # including ones that don't bump the version. We don't use the region
+        # itself (the raycaster always redraws the whole image), but clearing
+        # it keeps up the contract that plugins reset it when they've caught
+        # up.
+        dirty = drawing.plugin_dirty
+        if dirty is not None:
+            drawing.plugin_dirty = None
+
+        # Nothing that affects the image has changed, so the previous result
+        # is still valid and the whole dispatch can be skipped. The hidden
+        # layer set matters too: toggling visibility re-uploads the texture
+        # but does not bump the version.
+        # The colors tuple goes in as-is: unlike in render.py, nothing here
+        # keeps the compared tuple alive between ticks, so its id could be
+        # recycled by a fresh-but-different palette.
+        state = (id(drawing), drawing.version, drawing.hidden_layers_by_axis,
+                 view_size, altitude, azimuth, drawing.palette.colors)
+        if dirty is None and state == self._last_state:
+            return
+        self._last_state = state
+
+        # Alternate between two render targets, so that imgui can keep reading
+        # the previous frame's texture while we draw into the other one. That
+        # way the finished image never needs to be copied anywhere.
+        self._frame = (self._frame + 1) % 2
+        texture = self._get_texture(view_size, self._frame)
+
+        gl.glUseProgram(self._program)
+        inv_matrix = self._get_inv_mvp_matrix(size, depth, view_size, altitude, azimuth)
+        gl.glUniformMatrix4fv(0, 1, gl.GL_FALSE, inv_matrix)
+
+        voxel_texture = _get_3d_texture(drawing.data.shape)
+        gl.glBindTextureUnit(0, voxel_texture.name)
+        # The same palette texture the 2D view samples; texelFetch does the
+        # byte-to-float conversion, so no float LUT has to be built here.
+        palette_texture = _update_palette(drawing.palette.colors)
+        gl.glBindTextureUnit(2, palette_texture.name)
+        gl.glBindImageTexture(0, texture.name, 0, gl.GL_FALSE, 0,
+                              gl.GL_WRITE_ONLY, gl.GL_RGBA8)
+        gl.glDispatchCompute((vw + 7) // 8, (vh + 7) // 8, 1)
+        gl.glMemoryBarrier(gl.GL_TEXTURE_FETCH_BARRIER_BIT)
+        gl.glUseProgram(0)
+
+        # Only published after the draw is complete, so imgui never sees a
+        # half-rendered image.
         self.texture = texture, view_size
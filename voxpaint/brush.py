@@ -1,7 +1,7 @@
-from functools import lru_cache
-
 import numpy as np
 
+from .util import instance_lru_cache
+
 
 class Brush:
 
@@ -9,7 +9,9 @@ class Brush:
         if size:
             assert len(size) == 2
             self.size = size
-            self.data = np.ones(size, dtype=np.uint32)
+            # Just a presence mask; the actual RGBA values are composited by
+            # get_draw_data, so one byte per pixel is plenty.
+            self.data = np.ones(size, dtype=np.uint8)
         else:
             self.data = data
             self.size = data.shape[:2]
@@ -17,9 +19,11 @@ class Brush:
         w, h = self.size
         self.center = (w // 2, h // 2)
             
-    @lru_cache(2)
+    @instance_lru_cache(8)
     def get_draw_data(self, color, colorize=False):
-        return np.clip(self.data, 0, 1) * color + 255 * 2**24
+        # The alpha byte is disjoint from the color index, so it can just be
+        # OR:ed in; one masked pass instead of clip + multiply + add.
+        return np.where(self.data != 0, np.uint32(color | 0xFF000000), np.uint32(0))
 
     def rotate(self, d):
         data = self.data
@@ -36,12 +40,12 @@ class Brush:
         
 class ImageBrush(Brush):
 
-    @lru_cache(2)    
+    @instance_lru_cache(8)
     def get_draw_data(self, color, colorize=False):
-        filled_pixels = np.clip(self.data, 0, 1)     
+        filled = self.data != 0
         if colorize:
             # Fill all non-transparent pixels with the same color
-            return (color + filled_pixels * 2**24).astype(np.uint32)
+            return np.where(filled, np.uint32(color | 2**24), np.uint32(0))
         else:
-            # Otiginal brush data
-            return (self.data + filled_pixels * 2**24).astype(np.uint32)
+            # Original brush data
+            return np.where(filled, self.data | np.uint32(2**24), np.uint32(0))
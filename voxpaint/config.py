@@ -31,8 +31,9 @@ def load_config():
 
 
 def save_config(window_size=None, recent_files=None):
+    # No need to read the old file back; we are handed everything we want
+    # to keep, so just write it out.
     config_file = configparser.ConfigParser()
-    config_file.read(CONFIG_FILE)
     if window_size:
         w, h = window_size
         config_file["window"] = {"size": f"{w} {h}"}
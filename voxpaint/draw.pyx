@@ -4,7 +4,7 @@ Implementations of primitive drawing operations on numpy arrays.
 
 cimport cython
 
-from libc.stdlib cimport abs as iabs
+from libc.stdlib cimport abs as iabs, malloc, realloc, free
 
 from .rect cimport Rectangle
 
@@ -172,54 +172,95 @@ cpdef draw_rectangle(unsigned int [:, :] pic, unsigned int [:, :] brush,
 
 @cython.boundscheck(False)  # Deactivate bounds checking
 @cython.wraparound(False)   # Deactivate negative indexing.        
+@cython.cdivision(True)
 cpdef draw_fill(unsigned int [:, :] pic, (int, int) point, unsigned int color):
 
-    # TODO kind of slow, and requires the GIL.
-
     cdef int startx, starty, w, h
     startx, starty = point
-    cdef list stack = [point]  # TODO maybe find some more C friendly way of keeping a stack
     w, h = pic.shape[:2]
     cdef unsigned int start_col = pic[startx, starty] & 0xFF
 
     if start_col == color & 0xFF:
         return
 
-    cdef int x, y, xmin, xmax, ymin, ymax, xstart
+    cdef int x, y, xmin, xmax, ymin, ymax
     cdef bint reach_top, reach_bottom
     xmin, xmax = w, 0
     ymin, ymax = h, 0
 
-    while stack:
-        x, y = stack.pop()
-        # search left
-        while x >= 0 and start_col == pic[x, y]:
-            x -= 1
-        x += 1
-        reach_top = reach_bottom = False
-
-        # search right
-        while x < w and pic[x, y] == start_col:
-            pic[x, y] = color  # color this pixel
-            xmin, xmax = min(xmin, x), max(xmax, x)
-            ymin, ymax = min(ymin, y), max(ymax, y)
-            if 0 < y < h - 1:
-
-                # check pixel above
-                if start_col == pic[x, y-1]:
-                    if not reach_top:
-                        stack.append((x, y-1))  # add previous line
-                        reach_top = True
-                elif reach_top:
-                    reach_top = False
-
-                # check pixel below
-                if start_col == pic[x, y+1]:
-                    if not reach_bottom:
-                        stack.append((x, y+1))  # add next line
-                        reach_bottom = True
-                elif reach_bottom:
-                    reach_bottom = False
-            x += 1
+    # A manually managed stack of (x, y) pairs, grown on demand, so that the
+    # whole fill can run without the GIL.
+    cdef int capacity = 1024
+    cdef int top = 0
+    cdef int *stack = <int *>malloc(2 * capacity * sizeof(int))
+    cdef int *new_stack
+    cdef bint out_of_memory = False
+    if stack == NULL:
+        raise MemoryError()
+
+    try:
+        with nogil:
+            stack[0] = startx
+            stack[1] = starty
+            top = 1
+
+            while top:
+                top -= 1
+                x = stack[2 * top]
+                y = stack[2 * top + 1]
+                # search left
+                while x >= 0 and start_col == pic[x, y]:
+                    x -= 1
+                x += 1
+                reach_top = reach_bottom = False
+
+                # search right
+                while x < w and pic[x, y] == start_col:
+                    pic[x, y] = color  # color this pixel
+                    xmin, xmax = min(xmin, x), max(xmax, x)
+                    ymin, ymax = min(ymin, y), max(ymax, y)
+                    if 0 < y < h - 1:
+
+                        # check pixel above
+                        if start_col == pic[x, y-1]:
+                            if not reach_top:
+                                if top + 2 > capacity:
+                                    capacity *= 2
+                                    new_stack = <int *>realloc(stack, 2 * capacity * sizeof(int))
+                                    if new_stack == NULL:
+                                        out_of_memory = True
+                                        break
+                                    stack = new_stack
+                                stack[2 * top] = x
+                                stack[2 * top + 1] = y - 1  # add previous line
+                                top += 1
+                                reach_top = True
+                        elif reach_top:
+                            reach_top = False
+
+                        # check pixel below
+                        if start_col == pic[x, y+1]:
+                            if not reach_bottom:
+                                if top + 2 > capacity:
+                                    capacity *= 2
+                                    new_stack = <int *>realloc(stack, 2 * capacity * sizeof(int))
+                                    if new_stack == NULL:
+                                        out_of_memory = True
+                                        break
+                                    stack = new_stack
+                                stack[2 * top] = x
+                                stack[2 * top + 1] = y + 1  # add next line
+                                top += 1
+                                reach_bottom = True
+                        elif reach_bottom:
+                            reach_bottom = False
+                    x += 1
+                if out_of_memory:
+                    break
+    finally:
+        free(stack)
+
+    if out_of_memory:
+        raise MemoryError()
 
     return Rectangle((xmin, ymin), (xmax-xmin+1, ymax-ymin+1))
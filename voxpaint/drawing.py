@@ -1,9 +1,15 @@
-from functools import lru_cache
+from collections import deque
 from typing import Optional, Tuple, List
 import os
-from threading import RLock
 from uuid import uuid4
 
+try:
+    # Cython reentrant lock with a much cheaper uncontended acquire, which is
+    # the normal case here. Optional; the stock RLock behaves the same.
+    from fastrlock.rlock import FastRLock as RLock
+except ImportError:
+    from threading import RLock
+
 import numpy as np
 import png
 
@@ -12,7 +18,7 @@ from .edit import (LayerEdit, PaletteEdit, LayerSwapEdit, LayersDeleteEdit, Laye
 from .ora import load_ora, save_ora
 from .palette import Palette
 from .rect import Rectangle
-from .util import Selectable, slice_union
+from .util import Selectable, instance_lru_cache, slice_union
 from .view import DrawingView
 
 
@@ -28,19 +34,28 @@ class Drawing:
     This is required for the undo/redo system.
     """
 
+    MAX_UNDOS = 1000
+
     def __init__(self, size: Optional[Shape]=None, data: Optional[np.ndarray]=None, palette: Palette=None,
                  path: str=None, hidden_layers=None):
+        # The data is kept in Fortran order (x fastest) since that is the
+        # order the GL textures expect; this way uploads are straight copies
+        # instead of strided transposes.
         if data is not None:
-            self._data = data
+            self._data = np.asfortranarray(data)
         elif size:
             if len(size) == 2:
                 shape = (*size, 1)
             elif len(size) == 3:
                 shape = size
-            self._data = np.zeros(shape, dtype=np.uint8)
+            self._data = np.zeros(shape, dtype=np.uint8, order="F")
         self.palette = palette or Palette()
         self.path = path
         self.uuid = str(uuid4())
+        # Computed once; every lru_cache keyed on the drawing hashes it on
+        # lookup, and a hash that never changes also keeps those caches
+        # working when the shape changes (equality is identity anyway).
+        self._hash = hash((id(self), self._data.shape))
 
         # "layers" aren't separate things, but really just "slices" in
         # a 3d array, depending on which direction is currently
@@ -57,8 +72,11 @@ class Drawing:
                                       else ((), (), ()))
         self.cursor = (0, 0, 0)  # Position of the "current" layer in each dimension
         
-        self.undos = []
-        self.redos = []
+        # Edits are compact (compressed diffs), but a long session can still
+        # accumulate a lot of them, so the history is bounded; the oldest
+        # edits silently fall off the far end.
+        self.undos = deque(maxlen=self.MAX_UNDOS)
+        self.redos = deque(maxlen=self.MAX_UNDOS)
 
         self.plugins = {}
         self.brushes = Selectable()
@@ -71,6 +89,10 @@ class Drawing:
         # textures and stuff. It will be reset once that is done, so it can't
         # be relied upon by anyone else.
         self.dirty = None
+        # Same idea, but consumed by plugins (e.g. the voxel plugin) so they
+        # can update incrementally instead of rescanning the whole drawing.
+        # TODO gets hairy if several plugins want to consume it.
+        self.plugin_dirty = None
         self.all_dirty()
 
         # The view keeps track of how the user is seeing the drawing.
@@ -79,29 +101,40 @@ class Drawing:
         self.view = DrawingView(self)
 
     def all_dirty(self):
-        self.dirty = self.full_slice
+        self.dirty = self.plugin_dirty = self.full_slice
         
     @property
     def full_slice(self):
-        return tuple(slice(0, c) for c in self.shape)
+        return self._get_full_slice(self.shape)
+
+    @instance_lru_cache(1)
+    def _get_full_slice(self, shape):
+        return tuple(slice(0, c) for c in shape)
         
     @property
     def data(self):
         return self._get_masked_data(self._data.shape, self.hidden_layers_by_axis)
 
-    @lru_cache(1)
+    @instance_lru_cache(1)
     def _get_masked_data(self, shape, hidden_layers):
         """
         The masked data is what most operations should work on, unless they need to
         touch hidden layers (which is probably not what the user expects?)
         """
-        masked_data = np.ma.masked_array(self._data, fill_value=0)
-        for axis, layers in enumerate(hidden_layers):
-            if layers:
-                slc = tuple(slice(None)
-                            if i != axis else layers
-                            for i in range(3))
-                masked_data[slc] = np.ma.masked
+        # The mask is built by OR-ing three broadcast 1d axis masks, one
+        # vectorized pass instead of a full-volume fancy-index fill per axis.
+        # In the common case of nothing hidden, no mask is allocated at all.
+        if any(hidden_layers):
+            axis_masks = []
+            for size, layers in zip(shape, hidden_layers):
+                m = np.zeros(size, dtype=bool)
+                m[list(layers)] = True
+                axis_masks.append(m)
+            mx, my, mz = axis_masks
+            mask = mx[:, None, None] | my[None, :, None] | mz[None, None, :]
+        else:
+            mask = np.ma.nomask
+        masked_data = np.ma.masked_array(self._data, mask=mask, fill_value=0)
         self.all_dirty()
         return masked_data
 
@@ -147,7 +180,7 @@ class Drawing:
     def rect(self):
         return self._get_rect(self.shape)
 
-    @lru_cache(1)
+    @instance_lru_cache(1)
     def _get_rect(self, shape):
         return Rectangle((0, 0), shape[:2])
 
@@ -155,10 +188,15 @@ class Drawing:
     def filename(self):
         return self._get_filename(self.path)
 
-    @lru_cache(1)
+    @instance_lru_cache(1)
     def _get_filename(self, path):
         return os.path.basename(path) if path else "[Unnamed]"
 
+    @instance_lru_cache(1)
+    def _get_ext(self, path):
+        _, ext = os.path.splitext(path)
+        return ext
+
     @property
     def brush(self):
         return self.brushes.current
@@ -169,7 +207,12 @@ class Drawing:
         w, h, image_data, info = reader.read()
         if "palette" not in info:
             raise NotImplementedError("Can't load non palette based PNG images.")
-        data = np.vstack(list(map(np.uint8, image_data))).T
+        # Fill a preallocated buffer row by row as pypng streams them, instead
+        # of stacking h temporary arrays; peak memory stays at one copy.
+        buf = np.empty((h, w), dtype=np.uint8)
+        for i, row in enumerate(image_data):
+            buf[i] = row
+        data = buf.T
         palette = Palette(info["palette"])
         return cls(data=np.dstack([data]), palette=palette, path=path)
     
@@ -181,21 +224,31 @@ class Drawing:
     
     def to_ora(self, path):
         view = self.get_view()
-        layers = list(view.layers)
+        # Snapshot the layers under the lock so that saving from another
+        # thread (autosave runs on a worker) can't see a half-applied edit.
+        # The PNG encoding then happens outside the lock, on the copies.
+        # Returns the version the snapshot corresponds to; edits made while
+        # the encoding runs are not in the file.
+        with self.lock:
+            layers = [layer.copy() for layer in view.layers]
+            version = self.version
         save_ora(self.size, layers, self.palette, path, hidden_layers=self.hidden_layers_by_axis)
+        return version
 
     def save(self, path=None, auto=False):
         "Save the drawing to a file, in the appropriate format inferred from the filename."
         path = path or self.path
         if not path:
             raise ValueError("Can't save drawing; no path given.")
-        _, ext = os.path.splitext(path)
+        ext = self._get_ext(path)
         if ext == ".ora":
-            self.to_ora(path)
+            saved_version = self.to_ora(path)
         else:
             raise ValueError(f"Can't save drawing; unknown format: {ext}")
         if not auto:
-            self.last_saved_version = self.version
+            # The version captured with the snapshot, not the current one:
+            # strokes painted while the encoding ran are still unsaved.
+            self.last_saved_version = saved_version
             self.path = path
 
     @property
@@ -207,6 +260,7 @@ class Drawing:
         with self.lock:
             slc = edit.perform(self)
         self.dirty = slice_union(slc, self.dirty, self.shape)
+        self.plugin_dirty = slice_union(slc, self.plugin_dirty, self.shape)
         self.version += 1
         self.undos.append(edit)
         self.redos.clear()
@@ -254,6 +308,7 @@ class Drawing:
         edit = LayerSwapEdit.create(self, from_index, to_index, axis)
         self._perform_edit(edit)
 
+    @instance_lru_cache(8)
     def _get_layer_slice(self, index, axis):
         return tuple(slice(None) if i != axis else index for i in range(3))
         
@@ -261,10 +316,11 @@ class Drawing:
         "Helper to swap layers for real. Keeps track of hidden layers, which is fiddly."
         slc1 = self._get_layer_slice(index1, axis)
         slc2 = self._get_layer_slice(index2, axis)
+        # Only one side needs a temporary copy for the swap. copyto with
+        # casting disabled goes straight to the fast same-dtype copy loop.
         data1 = self._data[slc1].copy()
-        data2 = self._data[slc2].copy()
-        self._data[slc1] = data2
-        self._data[slc2] = data1
+        np.copyto(self._data[slc1], self._data[slc2], casting="no")
+        np.copyto(self._data[slc2], data1, casting="no")
         
         hidden_layers = set(self.hidden_layers_by_axis[axis])
         if (index1 in hidden_layers and index2 not in hidden_layers):
@@ -280,8 +336,11 @@ class Drawing:
         # layer instead of under it as is now the case. But we also need a way to add a layer
         # at the bottom in that case.
         shape = list(self.shape)
-        shape[axis] = n       
-        edit = LayersInsertEdit.create(self, np.zeros(shape, dtype=np.uint8), index, axis, n)
+        shape[axis] = n
+        # A read-only broadcast zero view; no point materializing a blank
+        # slab just to describe "insert empty layers here".
+        zeros = np.broadcast_to(np.uint8(0), tuple(shape))
+        edit = LayersInsertEdit.create(self, zeros, index, axis, n)
         self._perform_edit(edit)
 
     def _really_insert_layers(self, data, index, axis, n):
@@ -331,6 +390,7 @@ class Drawing:
                 slc = edit.revert(self)
             self.redos.append(edit)
             self.dirty = slice_union(slc, self.dirty, self.shape)
+            self.plugin_dirty = slice_union(slc, self.plugin_dirty, self.shape)
             self.version = edit.version
         except IndexError:
             # No edits to undo.
@@ -344,6 +404,7 @@ class Drawing:
                 slc = edit.perform(self)
             self.undos.append(edit)
             self.dirty = slice_union(slc, self.dirty, self.shape)
+            self.plugin_dirty = slice_union(slc, self.plugin_dirty, self.shape)
             self.version += 1
         except IndexError:
             # No edits to redo.
@@ -370,9 +431,16 @@ class Drawing:
             self.show_layer(index, axis)
         
     def get_view(self, rotation=(0, 0, 0)):
+        return self._get_view(rotation)
+
+    @instance_lru_cache(8)
+    def _get_view(self, rotation):
+        # One shared view per rotation; views read drawing state lazily
+        # through their own identity-keyed caches, so no invalidation is
+        # needed here.
         return DrawingView(self, rotation)
     
     def __hash__(self):
-        return hash((id(self), self.shape))
+        return self._hash
 
     
@@ -1,10 +1,31 @@
 from dataclasses import dataclass
+from functools import lru_cache
 import numpy as np
 import zlib
 
 from .util import slice_union
 
 
+# Diffs smaller than this aren't worth DEFLATE's fixed setup cost; a one byte
+# prefix tells the two cases apart.
+COMPRESS_THRESHOLD = 4096
+
+
+def _pack(raw: bytes) -> bytes:
+    if len(raw) < COMPRESS_THRESHOLD:
+        return b"\x00" + raw
+    return b"\x01" + zlib.compress(raw, 1)
+
+
+# The small cache makes rapid undo/redo toggling of the same edits free:
+# bytes objects hash once and then remember it, so repeated lookups are cheap.
+@lru_cache(8)
+def _unpack(blob: bytes) -> bytes:
+    if blob[0] == 0:
+        return blob[1:]
+    return zlib.decompress(blob[1:])
+
+
 class Edit:
 
     @classmethod
@@ -27,11 +48,18 @@ class LayerEdit(Edit):
 
     @classmethod
     def create(cls, drawing, slc, data, tool):
-        mask = data.astype(np.bool)
-        diff = np.subtract(data, mask * drawing.data[slc], dtype=np.int16)
+        # Work on the raw array; going through the masked wrapper would both
+        # cost a mask consult per element and quietly unmask anything
+        # assigned to. Hiddenness only concerns reading, not edits.
+        # The subtraction only applies where the brush actually painted
+        # (elsewhere the diff is just the new value, i.e. zero), which the
+        # where= form expresses without materializing a masked copy of the
+        # old layer data.
+        diff = data.astype(np.int16)
+        np.subtract(diff, drawing._data[slc], out=diff, where=data != 0)
         return cls(
             slc,
-            zlib.compress(diff.tobytes()),
+            _pack(diff.tobytes()),
             [],  # tool.points,
             tool.color,
             drawing.version
@@ -40,17 +68,17 @@ class LayerEdit(Edit):
     def perform(self, drawing):
         slc = sx, sy, sz = self.slc
         shape = [abs(sx.stop - sx.start), abs(sy.stop - sy.start), abs(sz.stop - sz.start)]
-        diff = np.frombuffer(zlib.decompress(self.diff),
+        diff = np.frombuffer(_unpack(self.diff),
                              dtype=np.int16).reshape(shape)
-        drawing.data[slc] = np.add(drawing.data[slc], diff, casting="unsafe")
+        drawing._data[slc] = np.add(drawing._data[slc], diff, casting="unsafe")
         return slc
 
     def revert(self, drawing):
         slc = sx, sy, sz = self.slc
         shape = [abs(sx.stop - sx.start), abs(sy.stop - sy.start), abs(sz.stop - sz.start)]
-        diff = np.frombuffer(zlib.decompress(self.diff),
+        diff = np.frombuffer(_unpack(self.diff),
                              dtype=np.int16).reshape(shape)
-        drawing.data[slc] = np.subtract(drawing.data[slc], diff, casting="unsafe")
+        drawing._data[slc] = np.subtract(drawing._data[slc], diff, casting="unsafe")
         return slc
 
 
@@ -106,7 +134,7 @@ class LayersDeleteEdit(Edit):
             index,
             axis,
             n,
-            zlib.compress(data.tobytes()),
+            zlib.compress(data.tobytes(), 1),
             drawing.version
         )
 
@@ -135,7 +163,7 @@ class LayersInsertEdit(Edit):
             index,
             axis,
             n,
-            zlib.compress(data.tobytes()),
+            zlib.compress(data.tobytes(), 1),
             drawing.version
         )
 
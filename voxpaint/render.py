@@ -1,5 +1,5 @@
+from ctypes import byref
 from functools import lru_cache
-from itertools import chain
 
 import numpy as np
 from pyglet import gl
@@ -10,12 +10,117 @@ from fogl.texture import Texture, ByteTexture3D
 from fogl.vao import VertexArrayObject
 
 from .constants import Rx90, Ry90, Rz90
-from .texture import IntegerTexture
+from .texture import IntegerTexture, PaletteTexture
 
 
 EMPTY_COLOR = (gl.GLfloat * 4)(0, 0, 0, 0)
 
 
+class UploadBuffer:
+
+    """
+    A persistently mapped pixel buffer used as staging memory for texture
+    uploads. Writing into the mapped memory and then uploading with the buffer
+    bound as GL_PIXEL_UNPACK_BUFFER lets the driver DMA the data instead of
+    copying from a client pointer at call time. A small ring of slots is used
+    so we don't overwrite data the GPU may still be reading.
+    """
+
+    RING_SIZE = 3
+
+    def __init__(self, size):
+        self.size = size
+        flags = gl.GL_MAP_WRITE_BIT | gl.GL_MAP_PERSISTENT_BIT | gl.GL_MAP_COHERENT_BIT
+        name = gl.GLuint()
+        gl.glCreateBuffers(1, byref(name))
+        self.name = name.value
+        gl.glNamedBufferStorage(self.name, self.RING_SIZE * size, None, flags)
+        ptr = gl.glMapNamedBufferRange(self.name, 0, self.RING_SIZE * size, flags)
+        self._memory = (gl.GLubyte * (self.RING_SIZE * size)).from_address(ptr)
+        self._slot = 0
+
+    def write(self, array):
+        """
+        Copy an array into the next ring slot, in Fortran order, and return
+        the slot's byte offset. The copy goes straight from the (possibly
+        strided) source into the mapped memory, without any intermediate
+        bytes object.
+        """
+        self._slot = (self._slot + 1) % self.RING_SIZE
+        offset = self._slot * self.size
+        dest = np.frombuffer(self._memory, dtype=array.dtype,
+                             count=array.size, offset=offset)
+        np.copyto(dest.reshape(array.shape, order="F"), array)
+        return offset
+
+    def delete(self):
+        "Unmap and free the GL buffer. The instance must not be used afterwards."
+        self._memory = None
+        gl.glUnmapNamedBuffer(self.name)
+        gl.glDeleteBuffers(1, byref(gl.GLuint(self.name)))
+
+    def __enter__(self):
+        gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, self.name)
+
+    def __exit__(self, *args):
+        gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+
+
+class MappedBuffer:
+
+    """
+    A persistently mapped GL buffer exposed as plain memory. Unlike the ring
+    buffer above it's meant as a permanent backing store: the overlay array
+    lives directly in it, so brush strokes land in memory the driver can
+    upload from without any intermediate copy.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        flags = (gl.GL_MAP_READ_BIT | gl.GL_MAP_WRITE_BIT
+                 | gl.GL_MAP_PERSISTENT_BIT | gl.GL_MAP_COHERENT_BIT)
+        name = gl.GLuint()
+        gl.glCreateBuffers(1, byref(name))
+        self.name = name.value
+        gl.glNamedBufferStorage(self.name, size, None, flags)
+        ptr = gl.glMapNamedBufferRange(self.name, 0, size, flags)
+        self.memory = (gl.GLubyte * size).from_address(ptr)
+
+    def delete(self):
+        "Unmap and free the GL buffer. The instance must not be used afterwards."
+        self.memory = None
+        gl.glUnmapNamedBuffer(self.name)
+        gl.glDeleteBuffers(1, byref(gl.GLuint(self.name)))
+
+    def __enter__(self):
+        gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, self.name)
+
+    def __exit__(self, *args):
+        gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+
+
+_upload_buffers = {}
+
+
+def _get_upload_buffer(key, size):
+    """
+    Get the staging buffer for the given key, growing it if needed. Unlike an
+    lru_cache, this deletes the old GL buffer on replacement so that resizing
+    the drawing doesn't leak mapped GPU memory.
+    """
+    buf = _upload_buffers.get(key)
+    if buf is None or buf.size < size:
+        if buf is not None:
+            buf.delete()
+        buf = _upload_buffers[key] = UploadBuffer(size)
+    return buf
+
+
+# State of the most recent render, used to avoid redrawing the offscreen
+# buffer when nothing visible has changed.
+_last_state = None
+
+
 def render_view(window):
 
     """ Render the current view to a texture. """
@@ -33,52 +138,72 @@ def render_view(window):
     if overlay.dirty and overlay.lock.acquire(timeout=0.01):
         rect = overlay.dirty
         x0, y0, x1, y1 = rect.box()
-        overlay_data = overlay.data[x0:x1, y0:y1].tobytes("F")
-        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)  # Needed for writing 8bit data                
-        gl.glTextureSubImage2D(overlay_texture.name, 0, *rect.position, *rect.size,
-                               gl.GL_RGBA_INTEGER, gl.GL_UNSIGNED_BYTE, overlay_data)
-        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 4)
         overlay.dirty = None
         overlay.lock.release()
+        # The overlay array lives in a persistently mapped buffer, so the
+        # dirty rect can be uploaded straight from it; just tell GL how wide
+        # the full rows are.
+        with overlay.gl_buffer:
+            gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)  # Needed for writing 8bit data
+            gl.glPixelStorei(gl.GL_UNPACK_ROW_LENGTH, w)
+            gl.glTextureSubImage2D(overlay_texture.name, 0, *rect.position, *rect.size,
+                                   gl.GL_RGBA_INTEGER, gl.GL_UNSIGNED_BYTE,
+                                   4 * (y0 * w + x0))
+            gl.glPixelStorei(gl.GL_UNPACK_ROW_LENGTH, 0)
+            gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 4)
         changed = True
 
-    # Update the image texture
+    # Update the image texture. Since the dirty region is kept as a single
+    # union slice, a multi layer edit (fill, undo, rotation...) still comes
+    # out as one glTextureSubImage3D call instead of one upload per layer.
     data = drawing.data
     drawing_texture = _get_3d_texture(data.shape)
     if drawing.dirty:
+        pbo = _get_upload_buffer("drawing", data.size)
         with drawing.lock:
-            update_data = data[drawing.dirty].tobytes(order="F")
             sx, sy, sz = drawing.dirty
+            # The buffer copy sees raw bytes, so hidden voxels have to be
+            # zeroed out explicitly here. filled() only copies when a mask
+            # is actually set; with nothing hidden it's a no-op.
+            offset = pbo.write(np.ma.filled(data[drawing.dirty], 0))
             drawing.dirty = None
         sw = sx.stop - sx.start
         sh = sy.stop - sy.start
         sd = sz.stop - sz.start
-        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)  # Needed for writing 8bit data        
-        gl.glTextureSubImage3D(drawing_texture.name, 0,
-                               sx.start, sy.start, sz.start, sw, sh, sd,
-                               gl.GL_RED_INTEGER, gl.GL_UNSIGNED_BYTE,
-                               update_data)
-        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 4)
+        with pbo:
+            gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)  # Needed for writing 8bit data
+            gl.glTextureSubImage3D(drawing_texture.name, 0,
+                                   sx.start, sy.start, sz.start, sw, sh, sd,
+                                   gl.GL_RED_INTEGER, gl.GL_UNSIGNED_BYTE,
+                                   offset)
+            gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 4)
         changed = True
 
     # Render everything to the offscreen buffer
 
-    # TODO we actually should not have to redraw the offscreen_buffer unless something has changed
-    # (e.g. drawing, overlay, palette or cursor)
-
     offscreen_buffer = _get_offscreen_buffer(size)
-    colors = _get_colors(drawing.palette.colors)
+    palette_texture = _update_palette(drawing.palette.colors)
 
     vao = _get_vao()
     draw_program = _get_program()
-    empty_texture = _get_empty_texture(size)    
 
     cursor_pos = d - view.index - 1  # TODO why?
 
     other_layer_alpha = 0.3 if view.show_only_current_layer or view.layer_being_switched else 1.0
 
     T = _get_transform(view.rotation)
-    
+
+    # If no data was uploaded and nothing else that affects the offscreen
+    # buffer has changed, the old contents are still valid and we can skip
+    # the whole render pass. The colors tuple is identity-stable while the
+    # palette is unchanged, so it works as part of the key.
+    global _last_state
+    state = (id(drawing), drawing.version, view.rotation, cursor_pos,
+             other_layer_alpha, id(drawing.palette.colors), size)
+    if not changed and state == _last_state:
+        return offscreen_buffer
+    _last_state = state
+
     with vao, offscreen_buffer:
 
         gl.glEnable(gl.GL_BLEND)
@@ -86,31 +211,18 @@ def render_view(window):
         gl.glViewport(0, 0, w, h)
         gl.glClearBufferfv(gl.GL_COLOR, 0, EMPTY_COLOR)
 
-        with draw_program, drawing_texture:
+        with draw_program, drawing_texture, overlay_texture, palette_texture:
 
             gl.glUniformMatrix4fv(0, 1, gl.GL_FALSE, (gl.GLfloat*16)(*T))
             gl.glUniform3f(1, *view.direction)
-            gl.glUniform4fv(5, 256, colors)
-
-            # Draw the layers below the current one
-            if cursor_pos < d - 1:            
-                with empty_texture:
-                    gl.glUniform1f(2, other_layer_alpha)
-                    gl.glUniform2i(3, cursor_pos+1, d)
-                    gl.glDrawArrays(gl.GL_TRIANGLES, 0, 6)
-                
-            # Draw the current layer + overlay
-            with overlay_texture:
-                gl.glUniform1f(2, 1)
-                gl.glUniform2i(3, cursor_pos, cursor_pos + 1)
-                gl.glDrawArrays(gl.GL_TRIANGLES, 0, 6)
-                
-            # Draw the layers on top
-            if cursor_pos > 0:
-                with empty_texture:
-                    gl.glUniform1f(2, other_layer_alpha)
-                    gl.glUniform2i(3, 0, cursor_pos)
-                    gl.glDrawArrays(gl.GL_TRIANGLES, 0, 6)
+
+            # All the layers are composited in a single draw call; the shader
+            # handles the lowered alpha of the non-current layers as well as
+            # the overlay, so there's no need for three separate passes.
+            gl.glUniform1f(2, other_layer_alpha)
+            gl.glUniform2i(3, 0, d)
+            gl.glUniform1i(6, cursor_pos)
+            gl.glDrawArrays(gl.GL_TRIANGLES, 0, 6)
 
     return offscreen_buffer
 
@@ -149,17 +261,16 @@ def _get_overlay_texture(size):
 
 
 @lru_cache(1)
-def _get_empty_texture(size):
-    texture = IntegerTexture(size, unit=1)
-    texture.clear()
-    return texture
+def _get_palette_texture():
+    return PaletteTexture(unit=2)
 
 
 @lru_cache(1)
-def _get_colors(colors):
-    float_colors = chain.from_iterable((r / 255, g / 255, b / 255, a / 255)
-                                       for r, g, b, a in colors)
-    return (gl.GLfloat*(4*256))(*float_colors)
+def _update_palette(colors):
+    "Upload the palette to its texture. Cached so it only happens on change."
+    texture = _get_palette_texture()
+    texture.set_colors(colors)
+    return texture
 
 
 # TODO this stuff is duplicated (almost) in view.py
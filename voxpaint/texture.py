@@ -1,3 +1,6 @@
+from ctypes import byref
+
+import numpy as np
 from pyglet import gl
 
 from fogl.texture import Texture
@@ -14,3 +17,34 @@ class IntegerTexture(Texture):
 class ByteIntegerTexture(IntegerTexture):
 
     _type = gl.GL_R8UI
+
+
+class PaletteTexture:
+
+    """
+    A tiny 256x1 RGBA texture holding the palette. Shaders look colors up with
+    texelFetch, which also takes care of the byte->float conversion, so no
+    per-frame uniform upload is needed.
+    """
+
+    def __init__(self, unit=2):
+        self.unit = unit
+        name = gl.GLuint()
+        gl.glCreateTextures(gl.GL_TEXTURE_1D, 1, byref(name))
+        self.name = name.value
+        gl.glTextureStorage1D(self.name, 1, gl.GL_RGBA8, 256)
+
+    def set_colors(self, colors):
+        # One vectorized conversion instead of spraying 1024 Python ints
+        # through a ctypes varargs constructor.
+        data = np.asarray(colors, dtype=np.uint8)
+        gl.glTextureSubImage1D(self.name, 0, 0, 256,
+                               gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, data.ctypes.data)
+
+    def __enter__(self):
+        gl.glActiveTexture(gl.GL_TEXTURE0 + self.unit)
+        gl.glBindTexture(gl.GL_TEXTURE_1D, self.name)
+
+    def __exit__(self, *args):
+        gl.glActiveTexture(gl.GL_TEXTURE0 + self.unit)
+        gl.glBindTexture(gl.GL_TEXTURE_1D, 0)
@@ -36,8 +36,8 @@ class Tool(metaclass=abc.ABCMeta):
     # The following methods are optional, but without any of them, the tool
     # won't actually *do* anything.
 
-    # They all run on a thread separate from the main UI thread. Make sure
-    # to not do anything to the drawing without acquiring the proper locks.
+    # They are driven directly from the mouse event handlers on the main
+    # thread; the overlay methods still take the proper locks themselves.
     def start(self, view, point, buttons, modifiers):
         "Run once at the beginning of the stroke."
         self.points.append(point)
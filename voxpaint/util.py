@@ -1,4 +1,4 @@
-from functools import lru_cache, wraps
+from functools import lru_cache, partial, wraps
 import logging
 from time import time
 from tkinter import Tk, filedialog
@@ -7,6 +7,7 @@ from traceback import format_exc
 from euclid3 import Matrix4
 import imgui
 import pyglet
+from pyglet import gl
 
 
 def try_except_log(f):
@@ -233,6 +234,34 @@ class AutoResetting:
         self.value = self.default
     
 
+class instance_lru_cache:
+
+    """
+    Like lru_cache for methods, except that the cache is stored on each
+    instance instead of on the class. A cache on the class would keep a
+    reference to every instance (and all arguments) alive forever.
+    Supports cache_clear() per instance, just like lru_cache.
+    """
+
+    def __init__(self, maxsize=1):
+        self.maxsize = maxsize
+
+    def __call__(self, func):
+        self.func = func
+        self.name = f"_{func.__name__}_cache"
+        return self
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self.func
+        try:
+            return obj.__dict__[self.name]
+        except KeyError:
+            cached = lru_cache(self.maxsize)(partial(self.func, obj))
+            obj.__dict__[self.name] = cached
+            return cached
+
+
 def cache_clear(cached_func):
     """Decorator that calls cache_clear on the given lru_cached function after
     the decorated function gets called."""
@@ -273,6 +302,12 @@ def make_view_matrix(window_size, image_size, zoom, offset):
     return frust * view
 
 
+@lru_cache(1)
+def make_view_matrix_gl(window_size, image_size, zoom, offset):
+    "The view matrix as a ctypes float array, ready to pass straight to GL."
+    return (gl.GLfloat * 16)(*make_view_matrix(window_size, image_size, zoom, offset))
+
+
 @lru_cache(1)
 def make_view_matrix_inverse(window_size, image_size, zoom, offset):
     return make_view_matrix(window_size, image_size, zoom, offset).inverse()
@@ -1,9 +1,11 @@
-from functools import lru_cache
-from itertools import chain
+from itertools import chain, product
 import math
-from threading import RLock
 from typing import Tuple, Optional
 
+# Unlike drawing.py, this must be the stdlib lock: the renderer acquires the
+# overlay lock with a timeout, which fastrlock doesn't support.
+from threading import RLock
+
 from euclid3 import Vector3
 import numpy as np
 
@@ -11,13 +13,76 @@ from .brush import Brush, ImageBrush
 from .constants import Rx90, Ry90, Rz90
 from .draw import draw_line, draw_rectangle, blit
 from .rect import Rectangle
-from .util import AutoResetting
+from .render import MappedBuffer
+from .util import AutoResetting, instance_lru_cache
 
 
 def make_translation(x, y, z):
     return np.matrix([[1, 0, 0, x], [0, 1, 0, y], [0, 0, 1, z], [0, 0, 0, 1]])
 
 
+def _build_direction_table():
+    """
+    The view direction for every possible rotation, computed once at import.
+    Rotations are whole multiples of 90 degrees, so there's only a handful of
+    them, and looking the direction up beats doing euclid3 vector math (pure
+    Python) every time the rotation changes.
+    """
+    xaxis = Vector3(1, 0, 0)
+    yaxis = Vector3(0, 1, 0)
+    zaxis = Vector3(0, 0, 1)
+    table = {}
+    for rx, ry, rz in product(range(4), repeat=3):
+        v = Vector3(0, 0, 1)
+        if ry:
+            v = v.rotate_around(yaxis, -ry * math.pi/2)
+        if rx:
+            v = v.rotate_around(xaxis, -rx * math.pi/2)
+        if rz:
+            v = v.rotate_around(zaxis, -rz * math.pi/2)
+        table[rx, ry, rz] = tuple(int(round(a)) for a in v)
+    return table
+
+
+DIRECTIONS = _build_direction_table()
+
+
+def _rot90_chain(data, rotation):
+    "The original definition of a view rotation, as a chain of np.rot90 calls."
+    # TODO this seems correct at least for the limited rotating we currently do...
+    # But do figure out a more elegant way.
+    rx, ry, rz = rotation
+    if rz:
+        data = np.rot90(data, rz, (0, 1))
+    if rx:
+        data = np.rot90(data, rx, (1, 2))
+    if ry:
+        data = np.rot90(data, ry, (2, 0))
+    return data
+
+
+def _build_rotation_table():
+    """
+    Every rotation chain boils down to an axis permutation plus some axis
+    flips. Trace each of the 64 possible chains once on a small probe array
+    and record the permutation and flips, so that applying a rotation is a
+    single transpose and one slicing instead of three np.rot90 calls.
+    """
+    probe = np.zeros((2, 3, 5), dtype=np.uint8)
+    axis_by_stride = {abs(s): i for i, s in enumerate(probe.strides)}
+    table = {}
+    for rotation in product(range(4), repeat=3):
+        rotated = _rot90_chain(probe, rotation)
+        axes = tuple(axis_by_stride[abs(s)] for s in rotated.strides)
+        flips = tuple(slice(None, None, -1) if s < 0 else slice(None)
+                      for s in rotated.strides)
+        table[rotation] = (axes, flips)
+    return table
+
+
+ROTATIONS = _build_rotation_table()
+
+
 class DrawingView:
 
     """
@@ -40,9 +105,12 @@ class DrawingView:
 
         self.offset = (0, 0)
         self.zoom = 2
-        
+
         self.show_only_current_layer = False
 
+        # Overlays by size, most recently used last; see _get_overlay.
+        self._overlays = {}
+
     def rotate(self, dx: int=0, dy: int=0, dz: int=0):
         "Rotation is given in whole multiples of 90 degrees."
         pitch, yaw, roll = self.rotation
@@ -64,24 +132,30 @@ class DrawingView:
             
     @property
     def data(self):
-        return self._get_data(self.drawing.data.shape, self.rotation)
-
-    @lru_cache(1)
-    def _get_data(self, shape: Tuple[int, int, int], rotation: Tuple[int, int, int]):
+        drawing = self.drawing
+        data = drawing.data
+        # The unrotated front view is by far the most common case and needs
+        # no transforming at all, so skip even the cache lookup for it.
+        if self.rotation == (0, 0, 0):
+            return data
+        # The key spells out everything the rotated view derives from: the
+        # version covers edits that replace the backing array (flips,
+        # rotations, layer ops) and the hidden set covers visibility
+        # changes. Object identity is no use here — CPython recycles ids,
+        # so a fresh masked wrapper can alias a stale cache entry.
+        return self._get_data(data.shape, drawing.version,
+                              drawing.hidden_layers_by_axis, self.rotation)
+
+    # 24 slots cover every rotation of the same data, so flipping back and
+    # forth between views never needs to redo the rot90 stride juggling.
+    @instance_lru_cache(24)
+    def _get_data(self, shape: Tuple[int, int, int], version: int,
+                  hidden_layers, rotation: Tuple[int, int, int]):
         " Return a ndarray view on the drawing data, rotated properly. "
-        data = self.drawing.data
-        rx, ry, rz = rotation
-        # TODO this seems correct at least for the limited rotating we currently do...
-        # But do figure out a more elegant way.
-        if rz:
-            data = np.rot90(data, rz, (0, 1))
-        if rx:
-            data = np.rot90(data, rx, (1, 2))
-        if ry:
-            data = np.rot90(data, ry, (2, 0))
         # Layer visibility is implemented using a masked array. This makes it
         # pretty much transparent (ho ho) to the rest of the application.
-        return data
+        axes, flips = ROTATIONS[rotation]
+        return self.drawing.data.transpose(axes)[flips]
 
     def _unrotate_array(self, a, rotation):
         rx, ry, rz = rotation
@@ -95,29 +169,13 @@ class DrawingView:
     
     @property
     def direction(self):
-        return self._get_direction(self.rotation)
-
-    @lru_cache(1)
-    def _get_direction(self, rotation: Tuple[int, int, int]):
         """
-        Return a vector pointing in the positive direction of the current view.
+        A vector pointing in the positive direction of the current view.
         That means the direction in which the layer structure is stacked,
         i.e. "up". The "index" tells where along this axis the cursor is.
         """
-        # TODO This is pretty crude. Also, use numpy instead of euclid?
-        rx, ry, rz = rotation
-        v = Vector3(0, 0, 1)
-        zaxis = Vector3(0, 0, 1)
-        xaxis = Vector3(1, 0, 0)
-        yaxis = Vector3(0, 1, 0)
-        if ry:
-            v = v.rotate_around(yaxis, -ry * math.pi/2)
-        if rx:
-            v = v.rotate_around(xaxis, -rx * math.pi/2)        
-        if rz:
-            v = v.rotate_around(zaxis, -rz * math.pi/2)
-        return tuple(int(a) for a in v)
-    
+        return DIRECTIONS[self.rotation]
+
     @property
     def shape(self):
         return self.data.shape
@@ -135,9 +193,8 @@ class DrawingView:
         "The depth of the current layer index as seen from the user."
         return self._get_index(self.direction, self.data.shape, self.cursor)
 
-    @lru_cache(1)
+    @instance_lru_cache(1)
     def _get_index(self, direction, shape, cursor):
-        self._get_index
         x, y, z = direction
         d = shape[2]
         cx, cy, cz = cursor
@@ -156,7 +213,16 @@ class DrawingView:
         
     def layer(self, index: int=None):
         index = index if index is not None else self.index
-        return self.data[:, :, index]
+        drawing = self.drawing
+        return self._get_layer(drawing.shape, drawing.version,
+                               drawing.hidden_layers_by_axis, self.rotation, index)
+
+    # Saving iterates over every layer, so keep the 2d slices around too.
+    # Keyed the same way as _get_data, for the same reasons.
+    @instance_lru_cache(64)
+    def _get_layer(self, shape: Tuple[int, int, int], version: int,
+                   hidden_layers, rotation: Tuple[int, int, int], index: int):
+        return self._get_data(shape, version, hidden_layers, rotation)[:, :, index]
 
     @property
     def layers(self):
@@ -170,9 +236,22 @@ class DrawingView:
         """
         return self._get_overlay(self.shape[:2])
 
-    @lru_cache(3)
     def _get_overlay(self, size: Tuple[int, int]):
-        return Overlay(size)
+        # Not an lru_cache: every overlay owns a mapped GL buffer that has
+        # to be freed explicitly, so eviction must be able to delete it
+        # (same reason _get_upload_buffer in render.py is hand-rolled).
+        # Re-inserting on every access makes the dict order LRU, so the
+        # overlay in active use is never the one evicted.
+        overlay = self._overlays.pop(size, None)
+        if overlay is None:
+            overlay = Overlay(size)
+        self._overlays[size] = overlay
+        # Six sizes cover every rotation of a box-shaped drawing; beyond
+        # that (e.g. after resizes) the stalest ones are freed.
+        while len(self._overlays) > 6:
+            oldest = next(iter(self._overlays))
+            self._overlays.pop(oldest).delete()
+        return overlay
     
     def modify(self, slc3: Tuple[slice, slice, slice], data, tool):
         self.drawing.modify(slc3, data, self.rotation, tool)
@@ -217,7 +296,7 @@ class DrawingView:
         "The 'depth' axis."
         return self._get_axis(self.direction)
     
-    @lru_cache(1)
+    @instance_lru_cache(1)
     def _get_axis(self, direction):
         return [abs(d) for d in direction].index(1)  # TODO this is stupid
 
@@ -226,7 +305,7 @@ class DrawingView:
         "The two axes defining the 'plane' of the view."
         return self._get_axes(self.direction)
 
-    @lru_cache(1)
+    @instance_lru_cache(1)
     def _get_axes(self, direction):
         return tuple(chain(range(self.axis), range(self.axis + 1, 3)))
         
@@ -284,7 +363,7 @@ class DrawingView:
         "This transform should take us from the view's space to the drawing's space."
         return self._get_untransform(self.shape, self.drawing.data.shape, self.rotation)
 
-    @lru_cache(1)
+    @instance_lru_cache(1)
     def _get_untransform(self, shape, drawing_shape, rotation):
         w1, h1, d1 = shape
         T1 = make_translation(-w1 / 2, -h1 / 2, -d1 / 2)
@@ -338,14 +417,54 @@ class Overlay:
     
     def __init__(self, size: Tuple[int, int]):
         self.size = size
-        self.data = np.zeros(size, dtype=np.uint32)
+        w, h = size
+        # The array is allocated inside a persistently mapped GL buffer, so
+        # that drawing into it writes directly to memory the renderer can
+        # upload from, with no further copying. Fortran order (x fastest)
+        # matches what the GL texture upload wants.
+        self.gl_buffer = MappedBuffer(4 * w * h)
+        self.data = np.frombuffer(self.gl_buffer.memory,
+                                  dtype=np.uint32).reshape(size, order="F")
 
         self.lock = RLock()  # It is very important to grab this lock around all data changes!
                              # Drawing is done in a thread and can otherwise collide with the main thread.
         self.rect = Rectangle((0, 0), size)
-        
-        self.dirty = None  # After an edit, set this to the covering rect. This informs the renderer
-                           # that it should update its textures.
+
+        # The region touched since the renderer last looked, tracked as four
+        # ints rather than a Rectangle so that growing it per stroke segment
+        # is just a couple of comparisons, with no allocation. The renderer
+        # reads it back as a Rectangle through the dirty property.
+        self._dirty_x0 = self._dirty_y0 = 2**31
+        self._dirty_x1 = self._dirty_y1 = -2**31
+
+    @property
+    def dirty(self):
+        if self._dirty_x1 < self._dirty_x0:
+            return None
+        return Rectangle((self._dirty_x0, self._dirty_y0),
+                         (self._dirty_x1 - self._dirty_x0,
+                          self._dirty_y1 - self._dirty_y0))
+
+    @dirty.setter
+    def dirty(self, rect):
+        if rect is None:
+            self._dirty_x0 = self._dirty_y0 = 2**31
+            self._dirty_x1 = self._dirty_y1 = -2**31
+        else:
+            self._mark_dirty(rect)
+
+    def _mark_dirty(self, rect):
+        x0, y0, x1, y1 = rect.box()
+        self._dirty_x0 = min(self._dirty_x0, x0)
+        self._dirty_y0 = min(self._dirty_y0, y0)
+        self._dirty_x1 = max(self._dirty_x1, x1)
+        self._dirty_y1 = max(self._dirty_y1, y1)
+
+    def delete(self):
+        "Free the mapped GL buffer. The overlay must not be used afterwards."
+        with self.lock:
+            self.data = None
+            self.gl_buffer.delete()
 
     def clear_all(self):
         self.clear(self.rect)
@@ -356,7 +475,7 @@ class Overlay:
             x0, y0, x1, y1 = rect.box()
             with self.lock:
                 self.data[x0:x1, y0:y1] = 0
-            self.dirty = rect.unite(self.dirty)
+            self._mark_dirty(rect)
         return rect
 
     def blit_brush(self, brush, p: Tuple[int, int], color: int=0, colorize: bool=False):
@@ -370,7 +489,7 @@ class Overlay:
         x, y = p
         with self.lock:
             rect = blit(self.data, data, x, y)
-        self.dirty = rect.unite(self.dirty)
+        self._mark_dirty(rect)
         return rect
     
     def draw_line(self, brush: Brush, p0: Tuple[int, int], p1: Tuple[int, int], color: int=0, colorize: bool=False):
@@ -380,7 +499,7 @@ class Overlay:
         data = brush.get_draw_data(color, colorize)
         with self.lock:
             rect = draw_line(self.data, data, (int(x0-dx), int(y0-dy)), (int(x1-dx), int(y1-dy)))
-        self.dirty = rect.unite(self.dirty)
+        self._mark_dirty(rect)
         return rect
 
     def draw_rectangle(self, brush: Brush, pos, size, color=0, fill=False, colorize: bool=False):
@@ -390,7 +509,7 @@ class Overlay:
         with self.lock:
             rect = draw_rectangle(self.data, data, (x-dx, y-dy), size, color + 2**24, fill)
         if rect:
-            self.dirty = rect.unite(self.dirty)
+            self._mark_dirty(rect)
         return rect
 
     # TODO to be implemented
@@ -1,10 +1,8 @@
 from concurrent.futures import ThreadPoolExecutor
 from collections import OrderedDict
-from functools import lru_cache
 from typing import Tuple
 from traceback import print_exc
 import os
-from queue import Queue
 
 from euclid3 import Matrix4, Vector3
 import imgui
@@ -26,13 +24,12 @@ from .imgui_pyglet import PygletRenderer
 from .plugin import init_plugins, render_plugins_ui
 from .rect import Rectangle
 from .render import render_view
-from .stroke import make_stroke
 from .tool import (PencilTool, PointsTool, SprayTool,
                    LineTool, RectangleTool,  # EllipseTool,
                    SelectionTool, ColorPickerTool, LayerPickerTool, FillTool)
 from . import ui
-from .util import (make_view_matrix, try_except_log, Selectable, Selectable2, no_imgui_events,
-                   show_load_dialog, show_save_dialog, debounce)
+from .util import (make_view_matrix_gl, try_except_log, Selectable, Selectable2, no_imgui_events,
+                   show_load_dialog, show_save_dialog, debounce, instance_lru_cache)
 
 
 EMPTY_COLOR = (gl.GLfloat * 4)(0, 0, 0, 0)
@@ -48,6 +45,10 @@ class VoxpaintWindow(pyglet.window.Window):
         
         super().__init__(*args, **kwargs, caption="Voxpaint", resizable=True, vsync=False)
 
+        # Kept up to date by on_resize; get_size() goes through the windowing
+        # layer, which is too slow for things that run per mouse event.
+        self._size = self.get_size()
+
         self.recent_files = OrderedDict((k, None) for k in recent_files)
 
         self.vao = VertexArrayObject()
@@ -73,11 +74,14 @@ class VoxpaintWindow(pyglet.window.Window):
         self.push_handlers(self.keys)
 
         self.border_vao = VertexArrayObject(vertices_class=SimpleVertices)
+        # The border quad is constant in normalized coordinates; zoom, pan
+        # and image size are all applied by the view matrix uniform, so the
+        # vertices never need to be rewritten.
         self._border_vertices = self.border_vao.create_vertices(
-            [((0, 0, 0),),
-             ((0, 0, 0),),
-             ((0, 0, 0),),
-             ((0, 0, 0),)])
+            [((-0.5, 0.5, 0),),
+             ((0.5, 0.5, 0),),
+             ((0.5, -0.5, 0),),
+             ((-0.5, -0.5, 0),)])
 
         self.tools = Selectable2({
             tool.tool: tool
@@ -94,13 +98,16 @@ class VoxpaintWindow(pyglet.window.Window):
         self._brush = Brush((1, 1))
         self.stroke = None
         self.stroke_tool = None
+        self._stroke_args = None
+        self._stroke_pending = False
 
         self._error = None
 
         self.mouse_position = None
 
+        # Only used for things that must not block the UI, like file dialogs
+        # and saving. Strokes are driven directly from the event handlers.
         self.executor = ThreadPoolExecutor(max_workers=1)
-        self.mouse_event_queue = None
 
         self.imgui_renderer = PygletRenderer(self)
         io = imgui.get_io()
@@ -164,36 +171,43 @@ class VoxpaintWindow(pyglet.window.Window):
         
         if not self.drawing:
             return
-        if self.mouse_event_queue:
+        if self.stroke:
             return
         if button in (pyglet.window.mouse.LEFT,
                       pyglet.window.mouse.RIGHT):
 
             self.view.overlay.clear_all()
-            
-            self.mouse_event_queue = Queue()
+
             x, y = self._to_image_coords(x, y)
             initial_point = int(x), int(y)
-            self.mouse_event_queue.put(("mouse_down", initial_point, button, modifiers))
             if button == pyglet.window.mouse.LEFT:
                 color = self.drawing.palette.foreground
             else:
                 # Erasing always uses background color
                 color = self.drawing.palette.background
-                
+
             tool = self.tool(self.drawing, self.brush, color)
             self.autosave_drawing.cancel()
-            self.stroke = self.executor.submit(make_stroke, self.view, self.mouse_event_queue, tool)
-            self.stroke.add_done_callback(lambda s: self.executor.submit(self._finish_stroke, s))
-            self.stroke_tool = tool
+            tool.start(self.view, initial_point, button, modifiers)
+            self.stroke = self.stroke_tool = tool
+            self._stroke_args = (initial_point, button, modifiers)
+            self._stroke_pending = False
+            if tool.period is not None:
+                pyglet.clock.schedule_interval(self._stroke_tick, tool.period)
+
+    @try_except_log
+    def _stroke_tick(self, dt):
+        "For tools with a period: apply the latest mouse position at most once per period."
+        tool = self.stroke
+        if tool and self._stroke_pending:
+            self._stroke_pending = False
+            tool.draw(self.view, *self._stroke_args)
 
     # @cache_clear(get_layer_preview_texture)
     @try_except_log
-    def _finish_stroke(self, stroke):
-        "Callback that gets run every time a stroke is finished."
-        # Since this is a callback, stroke is a Future and is guaranteed to be finished.
+    def _finish_stroke(self, tool):
+        "Gets run every time a stroke is finished."
         self.stroke_tool = None
-        tool = stroke.result()
         if tool and tool.rect:
             s = tool.rect.as_slice()
             self.view.modify_layer(self.view.index, tool.rect, self.view.overlay.data[s], tool)
@@ -202,17 +216,21 @@ class VoxpaintWindow(pyglet.window.Window):
         else:
             # If no rect is set, the tool is presumed to not have changed anything.
             self.view.overlay.clear_all()
-        self.mouse_event_queue = None
         self.stroke = None
         if tool.restore_last:
             self.tools.restore()
         self.autosave_drawing()
-            
+
+    @try_except_log
     def on_mouse_release(self, x, y, button, modifiers):
-        if self.mouse_event_queue:
+        tool = self.stroke
+        if tool:
+            if tool.period is not None:
+                pyglet.clock.unschedule(self._stroke_tick)
             x, y = self._to_image_coords(x, y)
             pos = int(x), int(y)
-            self.mouse_event_queue.put(("mouse_up", pos, button, modifiers))
+            tool.finish(self.view, pos, button, modifiers)
+            self._finish_stroke(tool)
 
     def on_mouse_motion(self, x, y, dx, dy):
         "Callback for mouse motion without buttons held"
@@ -234,17 +252,31 @@ class VoxpaintWindow(pyglet.window.Window):
             # The mouse hasn't actually moved; do nothing
             return      
         self._update_cursor(x, y)
-        if self.stroke:
+        tool = self.stroke
+        if tool:
             # Add to ongoing stroke
             x, y = self._to_image_coords(x, y)
             ipos = int(x), int(y)
-            self.mouse_event_queue.put(("mouse_drag", ipos, button, modifiers))
+            args = (ipos, button, modifiers)
+            if args == self._stroke_args:
+                # Mouse has not moved to a different pixel, nothing to do
+                return
+            self._stroke_args = args
+            if tool.period is not None:
+                # The scheduled tick picks the position up, at the tool's pace.
+                self._stroke_pending = True
+            elif tool.ephemeral and tool.rect:
+                # Grabbing the lock to prevent flickering
+                with self.view.overlay.lock:
+                    self.view.overlay.clear(tool.rect)
+                    tool.draw(self.view, *args)
+            else:
+                tool.draw(self.view, *args)
         elif button == pyglet.window.mouse.MIDDLE:
             # Pan image
             ox, oy = self.offset
             self.offset = ox + dx, oy + dy
-            self._to_image_coords.cache_clear()
-            
+
     @no_imgui_events
     def on_mouse_scroll(self, x, y, scroll_x, scroll_y):
         if self.keys[key.LSHIFT]:
@@ -256,10 +288,8 @@ class VoxpaintWindow(pyglet.window.Window):
             ox, oy = self.offset
             ix, iy = self._to_image_coords(x, y)
             self.zoom = max(min(self.zoom + scroll_y, MAX_ZOOM), MIN_ZOOM)
-            self._to_image_coords.cache_clear()
             x2, y2 = self._to_window_coords(ix, iy)
             self.offset = ox + (x - x2), oy + (y - y2)
-            self._to_image_coords.cache_clear()
             
     def on_key_press(self, symbol, modifiers):
 
@@ -330,6 +360,10 @@ class VoxpaintWindow(pyglet.window.Window):
 
         if symbol in {key.LSHIFT, key.RSHIFT, key.LCTRL, key.RCTRL}:
             self.temp_tool = None
+
+    def on_resize(self, width, height):
+        super().on_resize(width, height)
+        self._size = (width, height)
             
     def on_draw(self):
         self._render_view()
@@ -348,15 +382,13 @@ class VoxpaintWindow(pyglet.window.Window):
         
         w, h, d = self.view.shape
         size = w, h
-        window_size = self.get_size()
+        window_size = self._size
 
         ob = render_view(self)
         
-        vm = make_view_matrix(window_size, size, self.zoom, self.offset)
-        vm = (gl.GLfloat*16)(*vm)
+        vm = make_view_matrix_gl(window_size, size, self.zoom, self.offset)
         gl.glViewport(0, 0, *window_size)
 
-        self._update_border(self.view.shape)
         with self.border_vao, self.line_program:
             gl.glUniformMatrix4fv(0, 1, gl.GL_FALSE, vm)
             r, g, b, a = self.drawing.palette.colors[0]  # Color 0 is currently hardcoded background
@@ -367,7 +399,7 @@ class VoxpaintWindow(pyglet.window.Window):
             # Draw the actual drawing
             with ob["color"]:
                 gl.glEnable(gl.GL_BLEND)
-                gl.glUniformMatrix4fv(0, 1, gl.GL_FALSE, (gl.GLfloat*16)(*vm))
+                gl.glUniformMatrix4fv(0, 1, gl.GL_FALSE, vm)
                 gl.glDrawArrays(gl.GL_TRIANGLES, 0, 6)
             self._draw_mouse_cursor()            
 
@@ -377,7 +409,7 @@ class VoxpaintWindow(pyglet.window.Window):
             gl.glDrawArrays(gl.GL_LINE_LOOP, 0, 4)
 
     def _render_gui(self):
-        w, h = self.get_size()
+        w, h = self._size
         
         imgui.new_frame()
         
@@ -444,8 +476,16 @@ class VoxpaintWindow(pyglet.window.Window):
         "Save the drawing, asking for a file name if neccessary."
         drawing = drawing or self.drawing
         if not ask_for_path and drawing.path:
-            drawing.save()
-            self._add_recent_file(drawing.path)
+            # Encoding a big drawing takes a while; do it on the worker
+            # thread like autosave does. to_ora snapshots under the lock so
+            # the user can keep painting meanwhile.
+
+            @try_except_log
+            def really_save():
+                drawing.save()
+                self._add_recent_file(drawing.path)
+
+            self.executor.submit(really_save)
         else:
             last_dir = self._get_latest_dir()
             # The point here is to not block the UI redraws while showing the
@@ -546,11 +586,12 @@ class VoxpaintWindow(pyglet.window.Window):
                 del self.recent_files[f]
                 break
             
-    @lru_cache(3)
     def _to_image_coords(self, x: float, y: float) -> Tuple[float, float]:
+        # Not cached: this is just a handful of multiply-adds, which is
+        # cheaper than the hashing a cache lookup would cost.
         "Convert window coordinates to image coordinates."
         w, h, _ = self.view.shape
-        ww, wh = self.get_size()
+        ww, wh = self._size
         scale = 2 ** self.zoom
         ox, oy = self.offset
         ix = (x - (ww / 2 + ox)) / scale + w / 2
@@ -560,14 +601,13 @@ class VoxpaintWindow(pyglet.window.Window):
     def _to_window_coords(self, x: float, y: float) -> Tuple[float, float]:
         "Convert image coordinates to window coordinates"
         w, h, _ = self.view.shape
-        ww, wh = self.get_size()
+        ww, wh = self._size
         scale = 2 ** self.zoom
         ox, oy = self.offset
         wx = scale * (x - w / 2) + ww / 2 + ox
         wy = -(scale * (y - h / 2) - wh / 2 - oy)
         return wx, wy
 
-    @lru_cache(1)
     def _over_image(self, x, y):
         if self.drawing:
             ix, iy = self._to_image_coords(x, y)
@@ -579,20 +619,20 @@ class VoxpaintWindow(pyglet.window.Window):
         if self.mouse_position is None:
             return
         x, y = self.mouse_position
-        w, h = self.get_size()
+        w, h = self._size
         vm = self._make_cursor_view_matrix(x, y)
         with self.mouse_texture:
             gl.glBlendFunc(gl.GL_ONE, gl.GL_ONE_MINUS_SRC_ALPHA)
-            gl.glUniformMatrix4fv(0, 1, gl.GL_FALSE, (gl.GLfloat*16)(*vm))
+            gl.glUniformMatrix4fv(0, 1, gl.GL_FALSE, vm)
             gl.glDrawArrays(gl.GL_TRIANGLES, 0, 6)
             gl.glBlendFunc(gl.GL_ONE, gl.GL_ZERO)
 
-    @lru_cache(1)
+    @instance_lru_cache(1)
     def _make_cursor_view_matrix(self, x, y):
 
         "Calculate a view matrix for placing the custom cursor on screen."
 
-        ww, wh = self.get_size()
+        ww, wh = self._size
         iw, ih = self.mouse_texture.size
 
         scale = 1
@@ -614,7 +654,7 @@ class VoxpaintWindow(pyglet.window.Window):
 
         view = Matrix4().new_translate(lx, ly, 0)
 
-        return frust * view
+        return (gl.GLfloat * 16)(*(frust * view))
             
     @try_except_log
     def _draw_brush_preview(self, x0, y0, x, y):
@@ -655,25 +695,7 @@ class VoxpaintWindow(pyglet.window.Window):
             self.mouse_position = None
             self.set_mouse_visible(True)
     
-    @lru_cache(1)
-    def _update_border(self, shape):
-        w, h, _ = shape
-        x0, y0 = 0, 0
-        x1, y1 = w, h
-        w2 = w / 2
-        h2 = h / 2
-        xw0 = (x0 - w2) / w
-        yw0 = (h2 - y0) / h
-        xw1 = (x1 - w2) / w
-        yw1 = (h2 - y1) / h
-        self._border_vertices.vertex_buffer.write([
-            ((xw0, yw0, 0),),
-            ((xw1, yw0, 0),),
-            ((xw1, yw1, 0),),
-            ((xw0, yw1, 0),)
-        ])
 
-        
 class OldpaintEventLoop(pyglet.app.EventLoop):
 
     "A tweaked event loop that lowers the idle refresh rate for less CPU heating."